@@ -1,9 +1,17 @@
 import os
 import logging
-import json
-from typing import Optional, Dict, Any, List, Tuple
-from datetime import datetime
+from typing import Optional, Dict, DefaultDict, Any, List, Sequence, Set, Tuple
+import time
 import asyncio
+from collections import defaultdict
+from dataclasses import dataclass, asdict
+from datetime import datetime, timezone
+
+try:
+    import orjson  # 高速JSON（任意）
+except ImportError:
+    orjson = None
+import json
 
 import discord
 from discord.ext import commands, tasks
@@ -12,7 +20,7 @@ from discord import app_commands
 # ===================== 環境変数 =====================
 DISCORD_TOKEN = os.getenv("DISCORD_TOKEN")  # 必須
 LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
-GUILD_IDS = [int(x.strip()) for x in os.getenv("GUILD_IDS", "").split(",") if x.strip().isdigit()]
+GUILD_IDS = [int(t) for t in (x.strip() for x in os.getenv("GUILD_IDS", "").split(",")) if t.isdigit()]
 DATA_DIR = os.getenv("DATA_DIR", ".")  # Railway Shared Disk を /data にマウント推奨
 # 共通バナー画像（Embed最下部に表示）。環境変数優先・未設定なら固定URLを使用
 BANNER_IMAGE_URL = os.getenv("BANNER_IMAGE_URL", "https://example.com/your-fixed-banner.png")
@@ -31,34 +39,239 @@ log = logging.getLogger("jumpbot")
 os.makedirs(DATA_DIR, exist_ok=True)
 DATA_FILE = os.path.join(DATA_DIR, "data.json")
 
-def load_data() -> Dict[str, Any]:
+@dataclass(slots=True)
+class JumpSet:
+    # 自動更新対象のパネル1件（メモリ上の表現。ファイルには従来どおりの JSON オブジェクトで保存）
+    guild_id: int
+    message_channel_id: int
+    message_id: int
+    channel_ids: Tuple[int, ...]
+    category_id: int
+    description: str
+    created_at: int
+
+    @classmethod
+    def from_dict(cls, d: Dict[str, Any]) -> "JumpSet":
+        created_at = d.get("created_at", 0)
+        if isinstance(created_at, str):  # 旧形式（ISO 8601 文字列）
+            try:
+                created_at = int(datetime.fromisoformat(created_at).replace(tzinfo=timezone.utc).timestamp())
+            except ValueError:
+                created_at = 0
+        return cls(
+            guild_id=d["guild_id"],
+            message_channel_id=d["message_channel_id"],
+            message_id=d["message_id"],
+            channel_ids=tuple(d.get("channel_ids", ())),
+            category_id=d.get("category_id", 0),
+            description=d.get("description", ""),
+            created_at=created_at,
+        )
+
+def _to_jump_sets(items: List[Any]) -> List[JumpSet]:
+    # 壊れたレコードは読み飛ばす（1件のために起動できなくならないように）
+    recs: List[JumpSet] = []
+    for d in items:
+        try:
+            recs.append(JumpSet.from_dict(d))
+        except Exception as e:
+            log.warning("Skipped broken jump_set record %r: %s", d, e)
+    return recs
+
+def _json_default(o: Any) -> Any:
+    # 標準 json 用（orjson は dataclass をそのまま出力できる）
+    if isinstance(o, JumpSet):
+        return asdict(o)
+    raise TypeError(f"Object of type {type(o).__name__} is not JSON serializable")
+
+def load_data() -> Optional[Dict[str, Any]]:
+    # ファイルが無ければ {}、あるのに読めなければ None（空データと区別する）
     if not os.path.exists(DATA_FILE):
         return {}
     try:
-        with open(DATA_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
+        if orjson is not None:
+            with open(DATA_FILE, "rb") as f:
+                data = orjson.loads(f.read())
+        else:
+            with open(DATA_FILE, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        if not isinstance(data, dict):
+            raise ValueError(f"unexpected top-level type {type(data).__name__}")
+        return data
     except Exception as e:
         log.exception("Failed to load data.json: %s", e)
-        return {}
+        return None
+
+def _set_aside_data_file() -> bool:
+    # 読めなかった data.json は上書きせず別名で残す（手動で復旧できるように）
+    corrupt = f"{DATA_FILE}.corrupt-{int(time.time())}"
+    try:
+        os.replace(DATA_FILE, corrupt)
+    except OSError as e:
+        log.error("Could not move unreadable %s aside: %s (compaction disabled)", DATA_FILE, e)
+        return False
+    log.warning("Moved unreadable %s to %s", DATA_FILE, corrupt)
+    return True
+
+def _dump_data(data: Dict[str, Any]) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+    return json.dumps(data, ensure_ascii=False, indent=2, default=_json_default).encode("utf-8")
+
+def _write_data_file(payload: bytes) -> None:
+    # 一時ファイルに書いてから置き換え（書き込み途中で落ちても data.json は壊れない）
+    tmp = DATA_FILE + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(payload)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, DATA_FILE)
+
+# ===== jump_sets の変更ログ（1行1操作の追記専用。起動時に data.json へ再適用） =====
+LOG_FILE = os.path.join(DATA_DIR, "jump_sets.log")
+
+def _dump_line(entry: Dict[str, Any]) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(entry) + b"\n"
+    return json.dumps(entry, ensure_ascii=False, default=_json_default).encode("utf-8") + b"\n"
+
+def _append_log(payload: bytes) -> None:
+    with open(LOG_FILE, "ab") as f:
+        f.write(payload)
+        f.flush()
+        os.fsync(f.fileno())
+
+def _compact_files(payload: bytes) -> None:
+    # スナップショットを書き直してからログを空にする
+    _write_data_file(payload)
+    with open(LOG_FILE, "wb") as f:
+        os.fsync(f.fileno())
+
+def replay_log(data: Dict[str, Any]) -> int:
+    # add/del は何度適用しても同じ結果になる（圧縮途中で落ちても二重登録にならない）
+    if not os.path.exists(LOG_FILE):
+        return 0
+    applied = 0
+    with open(LOG_FILE, "rb") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                entry = orjson.loads(line) if orjson is not None else json.loads(line)
+            except Exception:
+                log.warning("Skipped broken line in %s", LOG_FILE)
+                continue
+            # 1行ずつ検証し、不正な行だけ読み飛ばして残りは適用を続ける
+            try:
+                op = entry["op"]
+                if op == "add":
+                    rec = entry["rec"]
+                    mid = rec["message_id"]
+                elif op == "del":
+                    rec = None
+                    mid = entry["message_id"]
+                else:
+                    raise ValueError(f"unknown op {op!r}")
+            except (KeyError, TypeError, ValueError) as e:
+                log.warning("Skipped invalid entry in %s: %r (%s)", LOG_FILE, entry, e)
+                continue
+            data["jump_sets"] = [x for x in data["jump_sets"] if not (isinstance(x, dict) and x.get("message_id") == mid)]
+            if rec is not None:
+                data["jump_sets"].append(rec)
+            applied += 1
+    return applied
+
+# ログ追記と圧縮（スナップショット書き直し＋ログ切り詰め）の順序を保つ
+_log_lock = asyncio.Lock()
+
+async def append_log_async(entry: Dict[str, Any]) -> None:
+    # 1操作ぶんだけ追記（件数に関係なく書き込み量は一定）。ディスクI/Oは別スレッドへ
+    try:
+        payload = _dump_line(entry)
+        async with _log_lock:
+            await asyncio.to_thread(_append_log, payload)
+    except Exception as e:
+        log.exception("Failed to append %s: %s", LOG_FILE, e)
 
-def save_data(data: Dict[str, Any]) -> None:
+async def compact_data_async(data: Dict[str, Any]) -> None:
+    # シリアライズはロック内で行う（ログを空にする前の追記を取りこぼさないため）
     try:
-        with open(DATA_FILE, "w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
+        async with _log_lock:
+            payload = _dump_data(data)
+            await asyncio.to_thread(_compact_files, payload)
     except Exception as e:
-        log.exception("Failed to save data.json: %s", e)
+        log.exception("Failed to compact data.json: %s", e)
+
+def log_needs_compaction() -> bool:
+    if not _snapshot_ok:
+        return False  # 読めない data.json を置き換えてしまわないよう、圧縮しない
+    try:
+        log_size = os.path.getsize(LOG_FILE)
+    except OSError:
+        return False
+    snap_size = os.path.getsize(DATA_FILE) if os.path.exists(DATA_FILE) else 0
+    return log_size > 0 and log_size > snap_size
 
 DB = load_data()
+_snapshot_ok = True  # False の間は data.json を書き換えない（ログだけに追記する）
+if DB is None:
+    DB = {}
+    _snapshot_ok = _set_aside_data_file()
 DB.setdefault("jump_sets", [])  # 自動更新対象レコードの配列
+try:
+    replayed = replay_log(DB)
+except Exception as e:
+    replayed = 0
+    log.exception("Failed to replay %s: %s", LOG_FILE, e)
+DB["jump_sets"] = _to_jump_sets(DB["jump_sets"])
+if replayed and _snapshot_ok:
+    try:
+        _compact_files(_dump_data(DB))  # 起動時はまだループ外なので同期で圧縮
+    except Exception as e:
+        log.exception("Failed to compact data.json: %s", e)
+
+# ===== jump_sets の索引（DB["jump_sets"] と同じレコードを参照） =====
+_by_guild: DefaultDict[int, List[JumpSet]] = defaultdict(list)  # guild_id -> レコード
+_by_message: Dict[int, JumpSet] = {}  # message_id -> レコード
+_by_channel: Dict[int, Set[int]] = {}  # channel_id -> そのチャンネルのボタンを持つ message_id 集合
+
+def index_record(rec: JumpSet) -> None:
+    _by_guild[rec.guild_id].append(rec)
+    _by_message[rec.message_id] = rec
+    for cid in rec.channel_ids:
+        _by_channel.setdefault(cid, set()).add(rec.message_id)
+
+def unindex_record(rec: JumpSet) -> None:
+    recs = _by_guild.get(rec.guild_id)
+    if recs is not None:
+        recs.remove(rec)
+        if not recs:
+            del _by_guild[rec.guild_id]
+    _by_message.pop(rec.message_id, None)
+    for cid in rec.channel_ids:
+        mids = _by_channel.get(cid)
+        if mids is not None:
+            mids.discard(rec.message_id)
+            if not mids:
+                del _by_channel[cid]
+
+def rebuild_indexes() -> None:
+    _by_guild.clear()
+    _by_message.clear()
+    _by_channel.clear()
+    for rec in DB["jump_sets"]:
+        index_record(rec)
+
+rebuild_indexes()
 
 # ===================== Intents / Bot =====================
-intents = discord.Intents.default()
+# 必要なものだけ有効化（未使用イベントの受信・デコードを省く）
+# members は不要：ロール判定はインタラクションのメンバー情報、VC人数は voice_states で足りる
+intents = discord.Intents.none()
 intents.guilds = True
-intents.members = True
 intents.voice_states = True  # VC人数取得に必要
-intents.message_content = False  # テキスト内容は不要
 
-bot = commands.Bot(command_prefix="!", intents=intents)
+bot = commands.Bot(command_prefix="!", intents=intents, chunk_guilds_at_startup=False)
 tree = bot.tree
 
 # ===================== 権限チェック（指定ロール必須） =====================
@@ -66,7 +279,7 @@ def role_required(role_id: int):
     async def predicate(interaction: discord.Interaction) -> bool:
         if not isinstance(interaction.user, discord.Member):
             return False
-        return any(r.id == role_id for r in interaction.user.roles)
+        return interaction.user.get_role(role_id) is not None
     return app_commands.check(predicate)
 
 # ===================== ユーティリティ =====================
@@ -98,11 +311,12 @@ def label_for_channel(ch: discord.abc.GuildChannel) -> str:
         return f"🔊 {ch.name} ({n})"
     return ch.name
 
-def build_buttons_for(guild: discord.Guild, channel_ids: List[int]) -> Tuple[str, List[List[discord.ui.Button]], List[int], List[int]]:
+def build_buttons_for(guild: discord.Guild, channel_ids: Sequence[int]) -> Tuple[str, List[List[discord.ui.Button]], List[int], List[int]]:
     buttons: List[discord.ui.Button] = []
     ok_ids: List[int] = []
     ng_ids: List[int] = []
 
+    channel_ids = list(dict.fromkeys(channel_ids))  # 重複を除去（順序は維持）
     for cid in channel_ids:
         ch = resolve_channel(guild, cid)
         if not ch:
@@ -116,23 +330,78 @@ def build_buttons_for(guild: discord.Guild, channel_ids: List[int]) -> Tuple[str
     rows = split_rows(buttons, per_row=5)[:5]  # 1メッセージ最大25ボタン
     return ("", rows, ok_ids, ng_ids)
 
-async def edit_jump_message(guild: discord.Guild, channel_id: int, message_id: int, channel_ids: List[int]) -> bool:
+def panel_signature(guild: discord.Guild, channel_ids: Sequence[int]) -> Tuple[Tuple[int, str], ...]:
+    # ボタンの見た目（ラベル）が変わったかどうかの判定用。build_buttons_for と同じ 25 件までを対象
+    sig = []
+    for cid in dict.fromkeys(channel_ids):
+        ch = resolve_channel(guild, cid)
+        if ch:
+            sig.append((cid, label_for_channel(ch)))
+    return tuple(sig[:25])
+
+# 最後に反映したボタン内容（message_id -> signature）。変化がなければ編集しない
+_last_sig: Dict[int, Tuple[Tuple[int, str], ...]] = {}
+
+# パネルごとの View（message_id -> (View, ボタン一覧, ボタンに対応する channel_id 一覧)）
+# URL とスタイルは変わらないので、更新時はラベルだけ書き換えて使い回す
+_view_cache: Dict[int, Tuple[discord.ui.View, List[discord.ui.Button], List[int]]] = {}
+
+def panel_view(guild: discord.Guild, message_id: int, channel_ids: Sequence[int], sig: Tuple[Tuple[int, str], ...]) -> discord.ui.View:
+    ids = [cid for cid, _ in sig]
+    cached = _view_cache.get(message_id)
+    if cached and cached[2] == ids:
+        view, buttons, _ = cached
+        for btn, (_, label) in zip(buttons, sig):
+            btn.label = label
+        return view
+
+    _, rows, ok_ids, _ = build_buttons_for(guild, channel_ids)
+    view = make_view_from_rows(rows)
+    buttons = [b for row in rows for b in row]
+    _view_cache[message_id] = (view, buttons, ok_ids[:len(buttons)])
+    return view
+
+# 削除済みなどで編集できなくなったパネル（buttons_remove で対象から外すまで編集を試みない）
+_dead_messages: Set[int] = set()
+
+async def edit_jump_message(guild: discord.Guild, channel_id: int, message_id: int, channel_ids: Sequence[int], force: bool = False) -> bool:
+    if message_id in _dead_messages:
+        return False
     ch = guild.get_channel(channel_id)
     if not isinstance(ch, (discord.TextChannel, discord.Thread)):
         return False
-    try:
-        msg = await ch.fetch_message(message_id)
-    except:
-        return False
+    sig = panel_signature(guild, channel_ids)
+    if not force and _last_sig.get(message_id) == sig:  # force=True は手動更新（見た目が同じでも送り直す）
+        return True
 
-    _, rows, _, _ = build_buttons_for(guild, channel_ids)
+    # fetch_message は使わず PartialMessage で直接 PATCH（GET を省略）
+    msg = ch.get_partial_message(message_id)
+    view = panel_view(guild, message_id, channel_ids, sig)
     try:
-        await msg.edit(view=make_view_from_rows(rows))  # Embedは据え置き、ボタンだけ更新
+        await msg.edit(view=view)  # Embedは据え置き、ボタンだけ更新
+        _last_sig[message_id] = sig
         return True
+    except discord.NotFound:
+        _dead_messages.add(message_id)
+        log.warning("Message %s not found; use /buttons_remove to unregister it", message_id)
+        return False
     except Exception as e:
         log.warning("Failed to edit message %s: %s", message_id, e)
         return False
 
+# 同時に編集するメッセージ数の上限（429 回避）
+_edit_sem = asyncio.Semaphore(8)
+
+async def edit_jump_record(guild: discord.Guild, rec: JumpSet, force: bool = False) -> bool:
+    async with _edit_sem:
+        return await edit_jump_message(
+            guild,
+            rec.message_channel_id,
+            rec.message_id,
+            rec.channel_ids,
+            force=force
+        )
+
 def make_view_from_rows(rows: List[List[discord.ui.Button]]) -> discord.ui.View:
     v = discord.ui.View(timeout=None)
     for row in rows:
@@ -140,26 +409,66 @@ def make_view_from_rows(rows: List[List[discord.ui.Button]]) -> discord.ui.View:
             v.add_item(b)
     return v
 
-def add_jump_set_record(guild_id: int, message_channel_id: int, message_id: int, channel_ids: List[int], category_id: int, description: str):
-    DB["jump_sets"].append({
-        "guild_id": guild_id,
-        "message_channel_id": message_channel_id,
-        "message_id": message_id,
-        "channel_ids": channel_ids,
-        "category_id": category_id,
-        "description": description,
-        "created_at": datetime.utcnow().isoformat()
-    })
-    save_data(DB)
-
-def remove_jump_set_record(message_id: int) -> bool:
-    before = len(DB["jump_sets"])
-    DB["jump_sets"] = [x for x in DB["jump_sets"] if x.get("message_id") != message_id]
-    after = len(DB["jump_sets"])
-    if before != after:
-        save_data(DB)
-        return True
-    return False
+async def add_jump_set_record(guild_id: int, message_channel_id: int, message_id: int, channel_ids: List[int], category_id: int, description: str):
+    rec = JumpSet(
+        guild_id=guild_id,
+        message_channel_id=message_channel_id,
+        message_id=message_id,
+        channel_ids=tuple(channel_ids),
+        category_id=category_id,
+        description=description,
+        created_at=int(time.time())
+    )
+    DB["jump_sets"].append(rec)
+    index_record(rec)
+    await append_log_async({"op": "add", "rec": rec})
+
+async def remove_jump_set_record(message_id: int) -> bool:
+    rec = _by_message.get(message_id)
+    if rec is None:
+        return False
+    DB["jump_sets"].remove(rec)
+    unindex_record(rec)
+    _dead_messages.discard(message_id)
+    _last_sig.pop(message_id, None)
+    _view_cache.pop(message_id, None)
+    await append_log_async({"op": "del", "message_id": message_id})
+    return True
+
+# ===================== VC入退室での即時更新 =====================
+REFRESH_DEBOUNCE_SEC = 0.5  # 連続した入退室をまとめて1回の編集にする
+_pending_refresh: Dict[int, asyncio.TimerHandle] = {}
+_refresh_tasks: Set[asyncio.Task] = set()
+
+async def refresh_panel(message_id: int) -> None:
+    rec = _by_message.get(message_id)
+    if not rec:
+        return
+    guild = bot.get_guild(rec.guild_id)
+    if not guild:
+        return
+    await edit_jump_record(guild, rec)
+
+def _start_panel_refresh(message_id: int) -> None:
+    _pending_refresh.pop(message_id, None)
+    task = asyncio.create_task(refresh_panel(message_id))
+    _refresh_tasks.add(task)
+    task.add_done_callback(_refresh_tasks.discard)
+
+def schedule_panel_refresh(message_id: int) -> None:
+    if message_id in _pending_refresh:
+        return
+    loop = asyncio.get_running_loop()
+    _pending_refresh[message_id] = loop.call_later(REFRESH_DEBOUNCE_SEC, _start_panel_refresh, message_id)
+
+@bot.event
+async def on_voice_state_update(member: discord.Member, before: discord.VoiceState, after: discord.VoiceState):
+    if before.channel == after.channel:
+        return  # ミュート切替など（人数は変わらない）
+    changed = {c.id for c in (before.channel, after.channel) if c is not None}
+    for cid in changed:
+        for mid in _by_channel.get(cid, ()):
+            schedule_panel_refresh(mid)
 
 # ===================== on_ready & 同期 =====================
 @bot.event
@@ -183,6 +492,8 @@ async def on_ready():
 
     if not refresh_jump_messages.is_running():
         refresh_jump_messages.start()
+    if not compact_data_loop.is_running():
+        compact_data_loop.start()
 
 # ===================== エラーハンドラ =====================
 @tree.error
@@ -221,9 +532,8 @@ async def make_buttons(interaction: discord.Interaction, category_id: str, descr
     except:
         return await interaction.followup.send("category_id は数値で指定してください。", ephemeral=True)
 
-    raw_ids = [x.strip() for x in channel_ids.split(",") if x.strip()]
     try:
-        ids = [int(x) for x in raw_ids]
+        ids = list(dict.fromkeys(int(t) for x in channel_ids.split(",") if (t := x.strip())))
     except:
         return await interaction.followup.send("channel_ids に数値以外が含まれています。", ephemeral=True)
 
@@ -263,8 +573,9 @@ async def make_buttons(interaction: discord.Interaction, category_id: str, descr
         log.exception("Failed to send jump buttons: %s", e)
         return await interaction.followup.send("メッセージ送信に失敗しました。Botの送信権限を確認してください。", ephemeral=True)
 
-    # 自動更新に登録
-    add_jump_set_record(guild.id, interaction.channel.id, msg.id, ok_ids, cat_id, description)
+    # 自動更新に登録（送信直後の内容を反映済みとして記録）
+    _last_sig[msg.id] = panel_signature(guild, ok_ids)
+    await add_jump_set_record(guild.id, interaction.channel.id, msg.id, ok_ids, cat_id, description)
 
     skipped_all = sorted(set(skipped + ng_ids))
     note = f"\n⚠️ カテゴリ外/無効のIDをスキップ：{', '.join(map(str, skipped_all))}" if skipped_all else ""
@@ -278,18 +589,11 @@ async def buttons_refresh(interaction: discord.Interaction):
     if not guild:
         return await interaction.followup.send("サーバ内で実行してください。", ephemeral=True)
 
-    count = 0
-    for rec in DB.get("jump_sets", []):
-        if rec.get("guild_id") != guild.id:
-            continue
-        ok = await edit_jump_message(
-            guild,
-            rec["message_channel_id"],
-            rec["message_id"],
-            rec["channel_ids"]
-        )
-        if ok:
-            count += 1
+    results = await asyncio.gather(
+        *(edit_jump_record(guild, rec, force=True) for rec in list(_by_guild.get(guild.id, []))),
+        return_exceptions=True
+    )
+    count = sum(1 for ok in results if ok is True)
     await interaction.followup.send(f"更新しました：{count} 件", ephemeral=True)
 
 @tree.command(name="buttons_remove", description="自動更新の対象から外します")
@@ -300,35 +604,54 @@ async def buttons_remove(interaction: discord.Interaction, message_id: str):
         mid = int(message_id.strip())
     except:
         return await interaction.response.send_message("message_id は数値で指定してください。", ephemeral=True)
-    ok = remove_jump_set_record(mid)
+    ok = await remove_jump_set_record(mid)
     if ok:
         await interaction.response.send_message(f"対象から外しました（message_id: {mid}）。必要ならメッセージを手動で削除してください。", ephemeral=True)
     else:
         await interaction.response.send_message("対象が見つかりませんでした。", ephemeral=True)
 
-# ===================== 自動更新ループ（15秒ごと） =====================
-@tasks.loop(seconds=15.0)
+# ===================== 自動更新ループ（取りこぼし対策・5分ごと） =====================
+@tasks.loop(minutes=5.0)
 async def refresh_jump_messages():
     if not bot.is_ready():
         return
-    for rec in list(DB.get("jump_sets", [])):
-        guild = bot.get_guild(rec.get("guild_id"))
+    # ループ内で使う属性・関数はローカルに束縛しておく
+    get_guild = bot.get_guild
+    edit = edit_jump_record
+    coros = []
+    append = coros.append
+    for guild_id, recs in list(_by_guild.items()):
+        guild = get_guild(guild_id)
         if not guild:
             continue
-        await edit_jump_message(
-            guild,
-            rec["message_channel_id"],
-            rec["message_id"],
-            rec["channel_ids"]
-        )
+        for rec in recs:
+            append(edit(guild, rec))
+    await asyncio.gather(*coros, return_exceptions=True)
+
+async def wait_until_guild_available(timeout: float = 30.0) -> bool:
+    # wait_until_ready 直後はギルドのキャッシュが揃っていないことがあるので、揃うまで待つ
+    deadline = asyncio.get_running_loop().time() + timeout
+    while True:
+        if not any(g.unavailable for g in bot.guilds) and all(bot.get_guild(gid) for gid in GUILD_IDS):
+            return True
+        if asyncio.get_running_loop().time() >= deadline:
+            log.warning("Guild cache not ready after %.0fs; refreshing anyway", timeout)
+            return False
+        await asyncio.sleep(0.2)
 
 @refresh_jump_messages.before_loop
 async def before_refresh_loop():
     await bot.wait_until_ready()
+    await wait_until_guild_available()
+
+# ===================== 変更ログの圧縮（ログがスナップショットより大きくなったら） =====================
+@tasks.loop(minutes=10.0)
+async def compact_data_loop():
+    if log_needs_compaction():
+        await compact_data_async(DB)
 
 # ===================== FastAPI（任意：Railway Health Check） =====================
 try:
-    import threading
     from fastapi import FastAPI
     import uvicorn
 
@@ -338,11 +661,29 @@ try:
     def root():
         return {"status": "ok"}
 
-    def run_api():
-        port = int(os.getenv("PORT", "8080"))
-        uvicorn.run(api, host="0.0.0.0", port=port, log_level="warning")
+    api_server = uvicorn.Server(uvicorn.Config(
+        api,
+        host="0.0.0.0",
+        port=int(os.getenv("PORT", "8080")),
+        log_level="warning",
+        loop="asyncio",
+    ))
+    _api_tasks: Set[asyncio.Task] = set()
+
+    async def serve_api():
+        # 起動失敗時に uvicorn は sys.exit するので、Bot ごと落ちないようここで止める
+        try:
+            await api_server.serve()
+        except (SystemExit, Exception) as e:
+            log.warning("FastAPI server stopped: %r", e)
+
+    async def start_api():
+        # 別スレッドではなく Bot と同じイベントループ上で動かす
+        task = asyncio.create_task(serve_api())
+        _api_tasks.add(task)
+        task.add_done_callback(_api_tasks.discard)
 
-    threading.Thread(target=run_api, daemon=True).start()
+    bot.setup_hook = start_api
 except Exception as e:
     log.warning("FastAPI init skipped: %s", e)
 